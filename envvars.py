@@ -36,9 +36,71 @@ class cEnvVars:
 	MS_IPTABLES_HOST = "localhost"
 	MS_IPTABLES_PORT = 60001
 
+	# Settings read by load() from the environment, overridden by NAME=value
+	# lines in the file named by MS_IPTABLES_CONFIG: attribute, name, type, default
+	#
+	# RULE_SOURCE    - auto, exec, file or memory (auto = exec as root else memory)
+	# RULE_FILE_x    - iptables-save / ip6tables-save dump files for the file rule source
+	# STATS_INTERVAL - rule counter sampling interval in seconds
+	# STATS_SAMPLES  - number of rule counter samples kept
+	# DRAIN_TIMEOUT  - seconds in flight requests may take to finish at shutdown
+	# MAX_BODY       - largest accepted request body in bytes
+	# RECV_TIMEOUT   - seconds to wait for the complete request
+	# ADMIN_TOKEN    - bearer token of the /v1/admin endpoints, empty disables them
+	# PROFILE_x      - default profiling window in seconds, stack sampling interval
+	#                  in seconds, number of slowest requests kept, report directory
+	RULE_SOURCES = ["auto", "exec", "file", "memory"]
+
+	SETTINGS = [
+	("RULE_SOURCE",      "MS_IPTABLES_RULE_SOURCE",      str,   "auto"),
+	("RULE_FILE_4",      "MS_IPTABLES_RULE_FILE_4",      str,   "/etc/iptables/rules.v4"),
+	("RULE_FILE_6",      "MS_IPTABLES_RULE_FILE_6",      str,   "/etc/iptables/rules.v6"),
+	("STATS_INTERVAL",   "MS_IPTABLES_STATS_INTERVAL",   float, 10.0),
+	("STATS_SAMPLES",    "MS_IPTABLES_STATS_SAMPLES",    int,   6),
+	("DRAIN_TIMEOUT",    "MS_IPTABLES_DRAIN_TIMEOUT",    float, 10.0),
+	("MAX_BODY",         "MS_IPTABLES_MAX_BODY",         int,   1048576),
+	("RECV_TIMEOUT",     "MS_IPTABLES_RECV_TIMEOUT",     float, 10.0),
+	("ADMIN_TOKEN",      "MS_IPTABLES_ADMIN_TOKEN",      str,   ""),
+	("PROFILE_SECONDS",  "MS_IPTABLES_PROFILE_SECONDS",  float, 30.0),
+	("PROFILE_INTERVAL", "MS_IPTABLES_PROFILE_INTERVAL", float, 0.005),
+	("PROFILE_SLOWEST",  "MS_IPTABLES_PROFILE_SLOWEST",  int,   10),
+	("PROFILE_DIR",      "MS_IPTABLES_PROFILE_DIR",      str,   "/tmp"),
+	]
+
+	# settings which must be greater than 0
+	POSITIVE_SETTINGS = ["STATS_INTERVAL", "STATS_SAMPLES", "RECV_TIMEOUT"]
+
 	# Runtime
 	verbose_debug = False
 
+	# (Re)load the settings, nothing is changed if any value is invalid
+	def load():
+		values = dict(os.environ)
+		path = values.get("MS_IPTABLES_CONFIG", None)
+		if path is not None:
+			with open(path) as f:
+				for line in f:
+					line = line.strip()
+					if len(line) == 0 or line[0] == '#': continue
+					name, sep, value = line.partition('=')
+					if sep != '=': raise Exception("cEnvVars.load() {}: invalid line '{}'".format(path, line))
+					values[name.strip()] = value.strip()
+
+		settings = dict()
+		for attribute, name, type_, default in cEnvVars.SETTINGS:
+			try:
+				settings[attribute] = type_(values[name]) if name in values else default
+			except ValueError:
+				raise Exception("cEnvVars.load() {}: invalid value '{}'".format(name, values[name]))
+		if settings["RULE_SOURCE"] not in cEnvVars.RULE_SOURCES:
+			raise Exception("cEnvVars.load() MS_IPTABLES_RULE_SOURCE: invalid value '{}'. Valid sources: {}".format(
+			                settings["RULE_SOURCE"], " ".join(cEnvVars.RULE_SOURCES)))
+		for attribute, name, type_, default in cEnvVars.SETTINGS:
+			if attribute in cEnvVars.POSITIVE_SETTINGS and not settings[attribute] > 0:
+				raise Exception("cEnvVars.load() {}: invalid value '{}', must be greater than 0".format(name, settings[attribute]))
+		for attribute in settings:
+			setattr(cEnvVars, attribute, settings[attribute])
+
 	# Returns the directory the current script (or interpreter) is running in
 	def get_script_directory():
 		path = os.path.realpath(sys.argv[0])
@@ -47,3 +109,6 @@ class cEnvVars:
 		else:
 			return os.path.dirname(path)
 
+# the defaults until the program calls cEnvVars.load()
+for attribute, name, type_, default in cEnvVars.SETTINGS:
+	setattr(cEnvVars, attribute, default)
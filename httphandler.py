@@ -16,10 +16,13 @@
 # limitations under the License.
 #-------------------------------------------------------------------------------
 
-import datetime, json, pprint, re, sys, time
+import datetime, json, pprint, re, sys, time, urllib.parse
 
 from envvars import cEnvVars
 
+# query arguments selecting the output, not a filter
+OUTPUT_OPTIONS = ["fields", "format"]
+
 #-------------------------------------------------------------------------------
 # cHttpError
 #-------------------------------------------------------------------------------
@@ -31,35 +34,51 @@ class cHttpError(Exception):
 		self.response.errorResponse(instance=request.path, detail=message)
 		self.response.construct()
 
+#-------------------------------------------------------------------------------
+# cBadRequest - the request can not be parsed, no path is known to report
+#-------------------------------------------------------------------------------
+class cBadRequest(Exception):
+	pass
+
 #-------------------------------------------------------------------------------
 # cHttpRequest
 #-------------------------------------------------------------------------------
 class cHttpRequest:
 	def __init__(self, data):
-		self.data_in = str(data, "ascii")
+		header, sep, body = data.partition(b"\r\n\r\n")
+		self.data_in = str(header, "ascii")
+		self.body = str(body, "utf-8")
 		lines = self.data_in.split('\n')
 		self.extractMethodPath(lines.pop(0))
 		self.extractHeaderFields(lines)
 		self.splitPath()
+		self.extractQuery()
 		self.extractFilter()
 
+	# the filter is the first query argument which is not an output option
 	def extractFilter(self):
 		self.filter_name = None
 		self.filter_arg = None
-		if self.path_args is not None:
-			filter_parts = self.path_args.split('=')
-			if len(filter_parts)>0:
-				self.filter_name = filter_parts[0]
-			if len(filter_parts)>1 and len(filter_parts[1])>0:
-				self.filter_arg = filter_parts[1]
+		for name in self.query_args:
+			if name in OUTPUT_OPTIONS: continue
+			self.filter_name = name
+			if len(self.query_args[name])>0:
+				self.filter_arg = self.query_args[name]
+			break
 		if cEnvVars.verbose_debug:
 			print("filter: name {} arg {}".format(self.filter_name, self.filter_arg))
 
+	# all query arguments: /v1/rules/ipv4/evaluate?src=203.0.113.7&dport=443
+	def extractQuery(self):
+		self.query_args = dict()
+		if self.path_args is not None:
+			self.query_args = dict(urllib.parse.parse_qsl(self.path_args, keep_blank_values=True))
+
 	def extractHeaderFields(self, lines):
 		self.header_fields = dict()
 		for line in lines:
 			# drop the trailing '\r'
-			m = re.match(r'([^:]+):[\s]?(.*)$', line[:-1])
+			m = re.match(r'([^:]+):[\s]?(.*)$', line.rstrip('\r'))
 			if(m):
 				self.header_fields[m.group(1)] = m.group(2)
 			else:
@@ -71,7 +90,14 @@ class cHttpRequest:
 			self.method = m.group(1)
 			self.path = m.group(2)
 		else:
-			pass # error malformed request?
+			raise cBadRequest("Malformed request line")
+
+	# header field value by case insensitive name, None if missing
+	def headerField(self, name):
+		name = name.lower()
+		for field in self.header_fields:
+			if field.lower() == name: return self.header_fields[field]
+		return None
 
 	def printDataIn(self):
 		print(self.data_in)
@@ -160,6 +186,8 @@ class cHttpResponse:
 		401: "Unauthorized",
 		403: "Forbidden",
 		404: "Not Found",
+		408: "Request Timeout",
+		413: "Payload Too Large",
 		500: "Internal Server Error",
 		503: "Service Unavailable",
 		}
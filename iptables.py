@@ -18,42 +18,30 @@
 # limitations under the License.
 #-------------------------------------------------------------------------------
 
-import datetime, json, os, pprint, re, subprocess, sys, traceback
-
-from envvars import cEnvVars
-
-sample_rules_ipv4 = """
--P INPUT DROP
--A INPUT -i lo -j ACCEPT
--A INPUT -i enp1s0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
--A INPUT -i enp1s0 -p icmp -m icmp --icmp-type 8 -m comment --comment Public_ECHO -j ACCEPT
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 22 -m comment --comment Public_SSH -j ACCEPT
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 80 -m comment --comment Public_HTTP -j LOG_DROP2
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 443 -m comment --comment Public_HTTPS -j LOG_DROP2
--A INPUT -d 224.0.0.1/32 -i enp1s0 -j LOG_DROP3
--A INPUT -i enp1s0 -p udp -m udp --dport 137 -j LOG_DROP2
--A INPUT -i enp1s0 -p udp -m udp --dport 138 -j LOG_DROP2
--A INPUT -j LOG_DROP2
-"""
-
-sample_rules_ipv6 = """
--P INPUT DROP
--A INPUT -i lo -j ACCEPT
--A INPUT -i enp1s0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
--A INPUT -i enp1s0 -p ipv6-icmp -m comment --comment Public_ICMP -j LOG_DROP2
--A INPUT -s fe80::/10 -i enp1s0 -p udp -m state --state NEW -m udp --dport 546 -m comment --comment DHCP_546 -j ACCEPT
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 22 -m comment --comment Public_SSH -j ACCEPT
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 80 -m comment --comment Public_HTTP -j LOG_DROP2
--A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 443 -m comment --comment Public_HTTPS -j LOG_DROP2
--A INPUT -j LOG_DROP2
-"""
+import datetime, json, os, pprint, re, sys
+
+from envvars    import cEnvVars
+from rulesource import exec, get_rule_source
+from threading  import Lock
+
+# rule fields parsed on request for projections: ?fields=number,action,dport
+RULE_FIELDS = {
+"action":   re.compile(r'-j\s([^\s]+)|^-P\sINPUT\s([^\s]+)'),
+"protocol": re.compile(r'-p\s([^\s]+)'),
+"dport":    re.compile(r'--dports?\s([^\s]+)'),
+"comment":  re.compile(r'--comment\s([^\s]+)'),
+}
+
+# (source, snapshot keys, rule texts, parsed rules) of the last snapshot
+g_rules_cache = (None, None, None, None)
+g_rules_lock  = Lock()
 
 #-------------------------------------------------------------------------------
 # cIPTables
 #-------------------------------------------------------------------------------
 class cIPTables:
-	def __init__(self):
-		self.is_root = True if os.getuid()==0 else False
+	def __init__(self, source=None):
+		self.source = source if source is not None else get_rule_source()
 		self.fetch_ipv4_rules()
 		self.fetch_ipv6_rules()
 
@@ -66,25 +54,17 @@ class cIPTables:
 			close_rule = self.update_action(self.ipv6_rules["rules"][rule_number]["text"], cEnvVars.IPTABLES_6_CLOSE)
 			command = "/sbin/ip6tables -R INPUT {} {}".format(rule_number, close_rule)
 
-		if self.is_root:
+		if self.source.is_live:
 			ret = exec(command)
 		else:
 			print("cIPTables.close():", command)
 
 	def fetch_ipv4_rules(self):
-		if self.is_root:
-			ret = exec("/sbin/iptables -S INPUT")
-			self.ipv4_rules = self.parse_iptables_rules(ret["stdout"])
-		else:
-			self.ipv4_rules = self.parse_iptables_rules(sample_rules_ipv4)
+		self.ipv4_rules = self.parse_iptables_rules(self.source.fetch(4))
 		if cEnvVars.verbose_debug: pprint.pprint(self.ipv4_rules, width=160)
 
 	def fetch_ipv6_rules(self):
-		if self.is_root:
-			ret = exec("/sbin/ip6tables -S INPUT")
-			self.ipv6_rules = self.parse_iptables_rules(ret["stdout"])
-		else:
-			self.ipv6_rules = self.parse_iptables_rules(sample_rules_ipv6)
+		self.ipv6_rules = self.parse_iptables_rules(self.source.fetch(6))
 		if cEnvVars.verbose_debug: pprint.pprint(self.ipv6_rules, width=160)
 
 	def open(self, ver, rule_number):
@@ -96,12 +76,15 @@ class cIPTables:
 			open_rule = self.update_action(self.ipv6_rules["rules"][rule_number]["text"], cEnvVars.IPTABLES_6_OPEN)
 			command = "/sbin/ip6tables -R INPUT {} {}".format(rule_number, open_rule)
 
-		if self.is_root:
+		if self.source.is_live:
 			ret = exec(command)
 		else:
 			print("cIPTables.open():", command)
 
-	def parse_iptables_rules(self, text):
+	# "fields" holds the RULE_FIELDS values of all rules per field, filled in
+	# by rule_fields() on first use
+	@staticmethod
+	def parse_iptables_rules(text):
 		rules_in = text.split('\n')
 		#if cEnvVars.verbose_debug: pprint.pprint(rules_in)
 		rules_out = {
@@ -114,6 +97,7 @@ class cIPTables:
 		"udp":       [],
 		"bycomment": dict(),
 		"byport":    dict(),
+		"fields":    dict(),
 		}
 		rule_number = 0
 		for line in rules_in:
@@ -136,8 +120,8 @@ class cIPTables:
 			# lookup by comment
 			m = re.search(r'--comment\s([^\s]+)', line)
 			if m: rules_out["bycomment"][m.group(1)] = int(rule_number)
-			# lookup by port
-			m = re.search(r'--dport\s([^\s]+)', line)
+			# lookup by port, single ports only (not ranges 6000:6010)
+			m = re.search(r'--dport\s([0-9]+)(?:\s|$)', line)
 			if m: rules_out["byport"][int(m.group(1))] = int(rule_number)
 			# the rule text
 			rules_out["rules"].append({"number": rule_number, "text": line})
@@ -155,30 +139,62 @@ class cIPTables:
 			raise Exception("cIPTables.update_action()")
 
 #-------------------------------------------------------------------------------
-# exec - execute a command line, return [exception flag, stderr, stdout]
+# parse_rule_field - the value of one RULE_FIELDS field of a rule, None if the
+# rule does not have it
+def parse_rule_field(text, field):
+	m = RULE_FIELDS[field].search(text)
+	if not m: return None
+	value = m.group(m.lastindex)
+	if field == "dport" and value.isdigit(): return int(value)
+	return value
+
+#-------------------------------------------------------------------------------
+# get_rules - the parsed rules of both IP versions of the current rule source
+# snapshot, in the form of cIPTables.rules()
+#
+# A source with snapshot keys (file mtime and size, memory text) is not read
+# again while the keys are unchanged. Otherwise the rules are fetched and
+# parsed again only when the rule text changed. The result is shared between
+# requests and must not be modified.
+#-------------------------------------------------------------------------------
+def get_rules():
+	global g_rules_cache
+	source = get_rule_source()
+	keys = (source.snapshot_key(4), source.snapshot_key(6))
+	with g_rules_lock:
+		cached_source, cached_keys, cached_texts, rules = g_rules_cache
+		if None not in keys and cached_source is source and cached_keys == keys:
+			return rules
+
+	texts = (source.fetch(4), source.fetch(6))
+	with g_rules_lock:
+		cached_source, cached_keys, cached_texts, rules = g_rules_cache
+		if cached_source is source and cached_texts == texts:
+			g_rules_cache = (source, keys, texts, rules)
+			return rules
+
+	rules = {
+	"ipv4": cIPTables.parse_iptables_rules(texts[0]),
+	"ipv6": cIPTables.parse_iptables_rules(texts[1]),
+	}
+	with g_rules_lock:
+		g_rules_cache = (source, keys, texts, rules)
+	return rules
+
+#-------------------------------------------------------------------------------
+# rule_fields - the values of one RULE_FIELDS field for all rules of one IP
+# version, parsed once per snapshot
 #-------------------------------------------------------------------------------
-def exec(cmdline):
-	stderror  = None
-	stdoutput = None
-	exception = False
-	try:
-		if cEnvVars.verbose_debug:
-			print("cmdline=[{}]\n        {}".format(cmdline, cmdline.split()))
-		proc = subprocess.run(cmdline.split(),
-							  stdout=subprocess.PIPE,
-							  stderr=subprocess.PIPE)
-		if proc.stderr is not None and len(proc.stderr) > 0:
-			stderror  = proc.stderr.decode()
-		if proc.stdout is not None and len(proc.stdout) > 0:
-			stdoutput = proc.stdout.decode()
-	except FileNotFoundError as e:
-		exception = True
-		stderror = traceback.print_exc()
-		stdoutput = "{}".format(e)
-	return { "exception":exception, "stderr":stderror, "stdout":stdoutput }
+def rule_fields(rules, field):
+	values = rules["fields"].get(field, None)
+	if values is None:
+		values = [parse_rule_field(rule["text"], field) for rule in rules["rules"]]
+		rules["fields"][field] = values
+	return values
 
 #-------------------------------------------------------------------------------
 if __name__ == "__main__":
 	# debug parsing
+	cEnvVars.load()
 	ipt = cIPTables()
 
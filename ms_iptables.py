@@ -28,84 +28,40 @@
 # limitations under the License.
 #-------------------------------------------------------------------------------
 
-import json, pprint, re, sys
+import hmac, json, pprint, re, sys
+
 
 from envvars      import cEnvVars
-from httphandler  import cHttpError, cHttpRequest, cHttpResponse
-from iptables     import cIPTables
+from httphandler  import OUTPUT_OPTIONS, cHttpError, cHttpRequest, cHttpResponse
+from iptables     import cIPTables, get_rules, rule_fields
+from profiler     import g_profiler
+from ruleindex    import get_rule_index, parse_packet
+from rulesource   import new_rule_source, set_rule_source
+from rulestats    import get_stats_sampler, start_stats_sampler
 from tcpserver    import ServerMain
 from threading    import Lock, Thread
 
 g_debug = False
+g_encoder = json.JSONEncoder()
 g_http = "http"
 g_lock = Lock()
 g_version = "v1"
 
-#-------------------------------------------------------------------------------
-def constructGetMethodResponseData(ipvx, ipt, request, content_out):
-	# rule set by key
-	def extract_rule_1(lookup, src, dest, error_message):
-		if lookup is None: raise cHttpError(request, 400, error_message)
-		dest["rules"] = []
-		for rule_number in lookup:
-			pprint.pprint(dest)
-			dest["rules"].append(src[rule_number])
-
-	# rule with unique value
-	def extract_rule_2(value, lookup, src, dest, error_message):
-		rule_number = lookup.get(value, None)
-		if rule_number is None: raise cHttpError(request, 400, error_message)
-		dest["rules"] = [ src[rule_number] ]
-
-	# construct the top level dictionary: ipv4 or ipv6
-	content_out[ipvx] = { "datetime": ipt[ipvx]["datetime"], "rules": dict() }
+# fields selectable with ?fields=
+PROJECTION_FIELDS = ["family", "number", "text", "action", "protocol", "dport", "comment", "xopen", "xclose"]
+NDJSON_FIELDS     = ["family", "number", "text", "xopen", "xclose"]
 
-	# is a single rule identified by request path part 4 (request.path_parts[3])
-	if len(request.path_parts) >= 4:
-		rule_number = int(request.path_parts[3])
-		try:
-			content_out[ipvx]["rules"] = [ ipt[ipvx]["rules"][rule_number] ]
-		except:
-			raise cHttpError(request, 404, "Invalid rule number")
-		return
+CONTENT_TYPE_JSON   = "application/json; charset=utf-8"
+CONTENT_TYPE_NDJSON = "application/x-ndjson; charset=utf-8"
 
-	# apply filter
-	if request.filter_name is None:
-		content_out[ipvx]["rules"] = ipt[ipvx]["rules"] # all rules
-	elif request.filter_name == "action":
-		action = {
-		"accept": ipt[ipvx]["accept"],
-		"drop": ipt[ipvx]["drop"]
-		}
-		extract_rule_1(action.get(request.filter_arg, None),
-		               ipt[ipvx]["rules"],
-		               content_out[ipvx],
-		               "Invalid filter action. Valid actions: accept drop")
-	elif request.filter_name == "comment":
-		extract_rule_2(request.filter_arg,
-		               ipt[ipvx]["bycomment"],
-		               ipt[ipvx]["rules"],
-		               content_out[ipvx],
-		               "Comment not found.")
-	elif request.filter_name == "port":
-		if request.filter_arg is None: raise cHttpError(request, 400, "Port number missing")
-		extract_rule_2(int(request.filter_arg),
-		               ipt[ipvx]["byport"],
-		               ipt[ipvx]["rules"],
-		               content_out[ipvx],
-		               "Port number not found.")
-	elif request.filter_name == "protocol":
-		protocol = {
-		"icmp": ipt[ipvx]["icmp"],
-		"tcp": ipt[ipvx]["tcp"],
-		"udp": ipt[ipvx]["udp"]
-		}
-		extract_rule_1(protocol.get(request.filter_arg, None),
-		               ipt[ipvx]["rules"],
-		               content_out[ipvx],
-		               "Invalid filter protocol. Valid protocols: icmp tcp udp")
-	else:
-		raise cHttpError(request, 400, "Invalid filter name. Valid names: action comment port protocol")
+#-------------------------------------------------------------------------------
+# The selected rules are copied, the snapshot rules are shared between requests
+def constructGetMethodResponseData(ipvx, ipt, request, content_out):
+	rules_in = ipt[ipvx]["rules"]
+	content_out[ipvx] = {
+	"datetime": ipt[ipvx]["datetime"],
+	"rules":    [dict(rules_in[rule_number]) for rule_number in selectRules(ipvx, ipt, request)],
+	}
 
 	if g_debug:
 		print("====================================================================")
@@ -113,15 +69,94 @@ def constructGetMethodResponseData(ipvx, ipt, request, content_out):
 		print("--------------------------------------------------------------------")
 
 #-------------------------------------------------------------------------------
-# Construct action href's
-def constructHrefs(ipvx, ipt, request):
+# Construct action href's for the commented rules of the response
+def constructHrefs(ipvx, ipt, request, content_out):
+	hrefs = hrefBases(ipvx, ipt, request)
+	for rule in content_out[ipvx]["rules"]:
+		base_url = hrefs.get(rule["number"], None)
+		if base_url is None: continue
+		rule["xopen"]  = base_url+"open"
+		rule["xclose"] = base_url+"close"
+
+# rule number -> action href base url of the commented rules
+def hrefBases(ipvx, ipt, request):
+	base_url = "{}://{}/{}/rules/{}/".format(g_http, request.header_fields["Host"], g_version, ipvx)
+	return { rule_number: "{}{}/".format(base_url, rule_number) for rule_number in ipt[ipvx]["bycomment"].values() }
+
+#-------------------------------------------------------------------------------
+# Project the selected rules of one IP version onto fields, missing values are
+# null. Without fields the NDJSON_FIELDS are used and rules without action
+# href's leave out xopen and xclose. Rule fields are taken from the per snapshot
+# rule_fields() lists and href's are built only when requested.
+def projectRules(ipvx, ipt, rule_numbers, fields, request):
 	rules_in = ipt[ipvx]["rules"]
-	bycomment = ipt[ipvx]["bycomment"]
-	for comment in bycomment:
-		rule_number = bycomment[comment]
-		base_url = "{}://{}/{}/rules/{}/{}/".format(g_http, request.header_fields["Host"], g_version, ipvx, rule_number)
-		rules_in[rule_number]["xopen"]  = base_url+"open"
-		rules_in[rule_number]["xclose"] = base_url+"close"
+	if fields is None or "xopen" in fields or "xclose" in fields:
+		hrefs = hrefBases(ipvx, ipt, request)
+
+	if fields is None:
+		rules_out = []
+		for rule_number in rule_numbers:
+			rule = { "family": ipvx, "number": rule_number, "text": rules_in[rule_number]["text"] }
+			base_url = hrefs.get(rule_number, None)
+			if base_url is not None:
+				rule["xopen"]  = base_url+"open"
+				rule["xclose"] = base_url+"close"
+			rules_out.append(rule)
+		return rules_out
+
+	columns = []
+	for field in fields:
+		if field == "family":
+			column = [ipvx] * len(rule_numbers)
+		elif field == "number":
+			column = rule_numbers
+		elif field == "text":
+			column = [rules_in[rule_number]["text"] for rule_number in rule_numbers]
+		elif field in ["xopen", "xclose"]:
+			operation = field[1:]
+			column = [hrefs[rule_number]+operation if rule_number in hrefs else None for rule_number in rule_numbers]
+		else:
+			values = rule_fields(ipt[ipvx], field)
+			column = [values[rule_number] for rule_number in rule_numbers]
+		columns.append(column)
+	return [dict(zip(fields, row)) for row in zip(*columns)]
+
+#-------------------------------------------------------------------------------
+# Evaluate packets against the INPUT chain of the request IP version
+#
+# GET  /v1/rules/ipv4/evaluate?src=203.0.113.7&proto=tcp&dport=443&iface=enp1s0
+# POST /v1/rules/ipv4/evaluate  [{"src": "203.0.113.7", "dport": 443, ...}, ...]
+#
+# One result per packet in request order, rule number 0 is the chain policy.
+def evaluatePackets(request, packets_in):
+	ipvx = request.path_parts[2]
+	ver = int(ipvx[-1:])
+	packets = []
+	for i, fields in enumerate(packets_in):
+		if not isinstance(fields, dict):
+			raise cHttpError(request, 400, "Packet {} is not an object".format(i))
+		try:
+			packets.append(parse_packet(ver, fields))
+		except ValueError as error:
+			raise cHttpError(request, 400, "Packet {}: {}".format(i, error))
+
+	try:
+		with g_profiler.locked(g_lock):
+			index = get_rule_index(ver)
+	except ValueError as error:
+		raise cHttpError(request, 503, "{}".format(error))
+
+	results = []
+	for packet in packets:
+		rule_number, verdict, approximate = index.evaluate(packet)
+		results.append({
+		"number":      rule_number,
+		"text":        index.rules[rule_number] if rule_number < len(index.rules) else None,
+		"verdict":     verdict,
+		"approximate": approximate,
+		})
+	with g_profiler.phase("encode"):
+		return json.dumps({ ipvx: { "datetime": index.datetime, "policy": index.policy, "results": results } })
 
 #-------------------------------------------------------------------------------
 def execOpenClose(request):
@@ -134,7 +169,7 @@ def execOpenClose(request):
 
 	rule_number = int(request.path_parts[3])
 	try:
-		with g_lock:
+		with g_profiler.locked(g_lock):
 			if request.path_parts[4] == "open":
 				cIPTables().open(int(request.path_parts[2][-1:]), rule_number)
 			else:
@@ -154,23 +189,117 @@ def execOpenClose(request):
 # /v1/rules/ipv4?comment=Public_HTTPS
 # /v1/rules/ipv6
 # /v1/rules/ipv6?port=443
+# /v1/rules/ipv4/stats
+# /v1/rules/ipv4/evaluate?src=203.0.113.7&proto=tcp&dport=443&iface=enp1s0
+#
+# The rule listings also accept the output options
+#
+# /v1/rules/ipv4?fields=number,action,dport
+# /v1/rules?format=ndjson                       one rule per line
 #
+# Return the content and its content type
 def getContent(request):
-	with g_lock:
-		ipt = cIPTables().rules()
+	if len(request.path_parts) == 4 and request.path_parts[3] in ["stats", "evaluate"]:
+		for option in OUTPUT_OPTIONS:
+			if option in request.query_args:
+				raise cHttpError(request, 400, "Output option '{}' is only supported for rule listings".format(option))
+		if request.path_parts[3] == "stats":
+			return (getStats(request), CONTENT_TYPE_JSON)
+		return (evaluatePackets(request, [request.query_args]), CONTENT_TYPE_JSON)
+
+	fields, ndjson = parseOutputOptions(request)
+
+	with g_profiler.locked(g_lock):
+		ipt = get_rules()
+
+	families = [ipvx for ipvx in ["ipv4", "ipv6"] if len(request.path_parts)==2 or request.path_parts[2]==ipvx]
+
+	# output options: project the selected rules of the snapshot
+	if ndjson or fields is not None:
+		with g_profiler.phase("encode"):
+			if ndjson:
+				lines = []
+				for ipvx in families:
+					lines.extend(map(g_encoder.encode, projectRules(ipvx, ipt, selectRules(ipvx, ipt, request), fields, request)))
+				return ("".join(line+"\n" for line in lines), CONTENT_TYPE_NDJSON)
+			content_out = dict()
+			for ipvx in families:
+				content_out[ipvx] = {
+				"datetime": ipt[ipvx]["datetime"],
+				"rules":    projectRules(ipvx, ipt, selectRules(ipvx, ipt, request), fields, request),
+				}
+			return (json.dumps(content_out), CONTENT_TYPE_JSON)
 
 	# construct the response content based on the URI and any filters
 	content_out = dict()
+	for ipvx in families:
+		constructGetMethodResponseData(ipvx, ipt, request, content_out)
+		constructHrefs(ipvx, ipt, request, content_out)
 
-	if len(request.path_parts)==2 or (len(request.path_parts)>2 and request.path_parts[2]=="ipv4"):
-		constructHrefs("ipv4", ipt, request)
-		constructGetMethodResponseData("ipv4", ipt, request, content_out)
+	with g_profiler.phase("encode"):
+		return (json.dumps(content_out), CONTENT_TYPE_JSON)
 
-	if len(request.path_parts)==2 or (len(request.path_parts)>2 and request.path_parts[2]=="ipv6"):
-		constructHrefs("ipv6", ipt, request)
-		constructGetMethodResponseData("ipv6", ipt, request, content_out)
+#-------------------------------------------------------------------------------
+# Per rule packet and byte counters and rule text from the latest background
+# sample, iptables is not run for the request
+def getStats(request):
+	ipvx = request.path_parts[2]
+	sampler = get_stats_sampler()
+	stats = sampler.stats(int(ipvx[-1:])) if sampler is not None else None
+	if stats is None:
+		raise cHttpError(request, 503, "Rule counters not sampled yet")
+
+	with g_profiler.phase("encode"):
+		return json.dumps({ ipvx: stats })
 
-	return json.dumps(content_out)
+#-------------------------------------------------------------------------------
+# Profiling control, requires the header
+# 'Authorization: Bearer <MS_IPTABLES_ADMIN_TOKEN>'
+#
+# GET /v1/admin/profile                            status and slowest requests
+# GET /v1/admin/profile/report                     last report as text
+# PUT /v1/admin/profile/start?seconds=30&requests=1000
+# PUT /v1/admin/profile/stop
+#
+def handleAdmin(request):
+	if len(cEnvVars.ADMIN_TOKEN) == 0:
+		raise cHttpError(request, 403, "Admin endpoints are disabled")
+	authorization = request.headerField("Authorization") or ""
+	if not hmac.compare_digest(authorization.encode(), "Bearer {}".format(cEnvVars.ADMIN_TOKEN).encode()):
+		raise cHttpError(request, 401, "Invalid admin token")
+
+	if len(request.path_parts) < 3 or len(request.path_parts) > 4 or request.path_parts[2] != "profile":
+		raise cHttpError(request, 404, "Resource path {} not found".format(request.path))
+	operation = request.path_parts[3] if len(request.path_parts) == 4 else None
+
+	response = cHttpResponse()
+	response.headerStatus(200)
+	response.headerDefaults()
+	if request.method == "GET" and operation is None:
+		status = g_profiler.status()
+		status["last"] = g_profiler.report
+		if status["last"] is not None: status["last"] = dict(status["last"], stacks=len(status["last"]["stacks"]))
+		response.setContent(json.dumps({ "profile": status }))
+	elif request.method == "GET" and operation == "report":
+		if g_profiler.report is None: raise cHttpError(request, 404, "No profile report")
+		response.header_lines["Content-Type"] = "text/plain; charset=utf-8"
+		response.header_lines["Content-Disposition"] = "attachment; filename=ms_iptables-profile.txt"
+		response.setContent(g_profiler.report_text(g_profiler.report))
+	elif request.method == "PUT" and operation == "start":
+		try:
+			seconds = float(request.query_args["seconds"]) if "seconds" in request.query_args else None
+			requests = int(request.query_args["requests"]) if "requests" in request.query_args else None
+		except ValueError:
+			raise cHttpError(request, 400, "Invalid seconds or requests")
+		if not g_profiler.start(seconds, requests): raise cHttpError(request, 400, "Profiling is active")
+		response.setContent("")
+	elif request.method == "PUT" and operation == "stop":
+		if not g_profiler.stop(): raise cHttpError(request, 400, "Profiling is not active")
+		response.setContent(json.dumps({ "profile": g_profiler.status() }))
+	else:
+		raise cHttpError(request, 400, "Invalid operation. Valid operations: GET profile, GET profile/report, PUT profile/start, PUT profile/stop")
+	response.construct()
+	return response
 
 #-------------------------------------------------------------------------------
 def handleDelete(request):
@@ -180,20 +309,22 @@ def handleDelete(request):
 
 #-------------------------------------------------------------------------------
 def handleGet(request):
-	content = getContent(request)
+	content, content_type = getContent(request)
 	response = cHttpResponse()
 	response.headerStatus(200)
 	response.headerDefaults()
+	response.header_lines["Content-Type"] = content_type
 	response.setContent(content)
 	response.construct()
 	return response
 
 #-------------------------------------------------------------------------------
 def handleHead(request):
-	content = getContent(request)
+	content, content_type = getContent(request)
 	response = cHttpResponse()
 	response.headerStatus(200)
 	response.headerDefaults()
+	response.header_lines["Content-Type"] = content_type
 	response.setContentLength(content)
 	response.construct()
 	return response
@@ -206,9 +337,24 @@ def handleInvalidMethod(request):
 
 #-------------------------------------------------------------------------------
 def handlePost(request):
-	raise cHttpError(request,
-	                 400,
-	                 "Adding rules is not supported".format(request.method))
+	if len(request.path_parts) != 4 or request.path_parts[3] != "evaluate":
+		raise cHttpError(request,
+		                 400,
+		                 "Adding rules is not supported".format(request.method))
+	try:
+		packets_in = json.loads(request.body)
+	except ValueError:
+		raise cHttpError(request, 400, "Request body is not valid JSON")
+	if not isinstance(packets_in, list):
+		raise cHttpError(request, 400, "Request body must be a list of packets")
+
+	content = evaluatePackets(request, packets_in)
+	response = cHttpResponse()
+	response.headerStatus(200)
+	response.headerDefaults()
+	response.setContent(content)
+	response.construct()
+	return response
 
 #-------------------------------------------------------------------------------
 def handlePut(request):
@@ -224,6 +370,8 @@ def handlePut(request):
 def iptablesHandler(request):
 	try:
 		validatePath(request)
+		if request.path_parts[1] == "admin":
+			return handleAdmin(request)
 		switch = {
 		"DELETE": handleDelete,
 		"GET":    handleGet,
@@ -235,6 +383,74 @@ def iptablesHandler(request):
 	except cHttpError as e:
 		return e.response
 
+#-------------------------------------------------------------------------------
+# Return the ?fields= list (None for all fields) and True for ?format=ndjson
+def parseOutputOptions(request):
+	fields = request.query_args.get("fields", None)
+	if fields is not None:
+		fields = [field for field in fields.split(',') if len(field) > 0]
+		for field in fields:
+			if field not in PROJECTION_FIELDS:
+				raise cHttpError(request, 400, "Invalid field '{}'. Valid fields: {}".format(field, " ".join(PROJECTION_FIELDS)))
+		if len(fields) == 0: raise cHttpError(request, 400, "Fields list is empty")
+
+	output_format = request.query_args.get("format", "json")
+	if output_format not in ["json", "ndjson"]:
+		raise cHttpError(request, 400, "Invalid format. Valid formats: json ndjson")
+	return (fields, output_format == "ndjson")
+
+#-------------------------------------------------------------------------------
+# Return the rule numbers selected by the path and filter, in rule order
+def selectRules(ipvx, ipt, request):
+	rules_in = ipt[ipvx]
+
+	# is a single rule identified by request path part 4 (request.path_parts[3])
+	if len(request.path_parts) >= 4:
+		rule_number = int(request.path_parts[3])
+		if rule_number >= len(rules_in["rules"]):
+			raise cHttpError(request, 404, "Invalid rule number")
+		return [ rule_number ]
+
+	# apply filter
+	if request.filter_name is None:
+		return range(len(rules_in["rules"])) # all rules
+	elif request.filter_name == "action":
+		action = {
+		"accept": rules_in["accept"],
+		"drop": rules_in["drop"]
+		}
+		rule_numbers = action.get(request.filter_arg, None)
+		if rule_numbers is None: raise cHttpError(request, 400, "Invalid filter action. Valid actions: accept drop")
+		return rule_numbers
+	elif request.filter_name == "comment":
+		rule_number = rules_in["bycomment"].get(request.filter_arg, None)
+		if rule_number is None: raise cHttpError(request, 400, "Comment not found.")
+		return [ rule_number ]
+	elif request.filter_name == "port":
+		if request.filter_arg is None: raise cHttpError(request, 400, "Port number missing")
+		rule_number = rules_in["byport"].get(int(request.filter_arg), None)
+		if rule_number is None: raise cHttpError(request, 400, "Port number not found.")
+		return [ rule_number ]
+	elif request.filter_name == "protocol":
+		protocol = {
+		"icmp": rules_in["icmp"],
+		"tcp": rules_in["tcp"],
+		"udp": rules_in["udp"]
+		}
+		rule_numbers = protocol.get(request.filter_arg, None)
+		if rule_numbers is None: raise cHttpError(request, 400, "Invalid filter protocol. Valid protocols: icmp tcp udp")
+		return rule_numbers
+	else:
+		raise cHttpError(request, 400, "Invalid filter name. Valid names: action comment port protocol")
+
+#-------------------------------------------------------------------------------
+# SIGHUP: apply the reloaded cEnvVars settings, the old rule source is kept if
+# the new one cannot be created
+def reloadConfiguration():
+	set_rule_source(new_rule_source(cEnvVars.RULE_SOURCE))
+	sampler = get_stats_sampler()
+	if sampler is not None: sampler.configure()
+
 #-------------------------------------------------------------------------------
 def validatePath(request):
 	# validate path length
@@ -245,7 +461,9 @@ def validatePath(request):
 	if request.path_parts[0] != "v1":
 		raise cHttpError(request, 400, "Supported version: v1")
 
-	# validate the resource path
+	# validate the resource path, admin paths are validated by handleAdmin()
+	if request.path_parts[1] == "admin":
+		return
 	if request.path_parts[1] != "rules":
 		raise cHttpError(request, 404, "Resource path {} not found".format(request.path))
 
@@ -253,10 +471,13 @@ def validatePath(request):
 	if len(request.path_parts) >= 3 and request.path_parts[2] not in ["ipv4", "ipv6"]:
 		raise cHttpError(request, 404, "Resource path {} not found".format(request.path))
 
-	# part 4 must be an integer
+	# part 4 must be an integer, stats or evaluate
 	if len(request.path_parts) >= 4:
-		m = re.match(r'[0-9]+/?', request.path_parts[3])
-		if not m: raise cHttpError(request, 404, "Resource path {} not found".format(request.path))
+		if request.path_parts[3] in ["stats", "evaluate"]:
+			if len(request.path_parts) > 4: raise cHttpError(request, 400, "URI path is invalid")
+		else:
+			m = re.match(r'[0-9]+/?', request.path_parts[3])
+			if not m: raise cHttpError(request, 404, "Resource path {} not found".format(request.path))
 
 	# >5 too many parts
 	if len(request.path_parts) > 5:
@@ -268,7 +489,10 @@ if __name__ == "__main__":
 	try:
 		if len(sys.argv) > 1 and sys.argv[1] == "-v":
 			cEnvVars.verbose_debug = True
-		ServerMain("IPTables", iptablesHandler)
+		cEnvVars.load()
+		set_rule_source(new_rule_source(cEnvVars.RULE_SOURCE))
+		start_stats_sampler()
+		ServerMain("IPTables", iptablesHandler, reloadConfiguration)
 	except Exception as error:
 		print("FATAL Exception:", error)
 		exit_code = 1
@@ -23,11 +23,28 @@ if os.isatty(sys.stdin.fileno()):
     print("Usage: curl -i -s -X GET http://localhost:60001/v1/rules |", sys.argv[0])
     print("       curl -i -s -X GET http://localhost:60001/v1/rules/ipv4 |", sys.argv[0])
     print("       curl -i -s -X GET http://localhost:60001/v1/rules/ipv4/5 |", sys.argv[0])
+    print("       curl -i -s -X GET 'http://localhost:60001/v1/rules?format=ndjson&fields=family,number,action,dport' |", sys.argv[0])
     print("       curl -i -s -X PUT http://localhost:60001/v1/rules/ipv4/5/open |", sys.argv[0])
 else:
+	ndjson = False
+	records = []
 	for line in sys.stdin:
-		if line[0:1] == '{':
+		line = line.rstrip('\r\n')
+		if line.lower().startswith("content-type:") and "ndjson" in line:
+			ndjson = True
+		if line[0:1] == '{' and ndjson:
+			records.append(json.loads(line))
+		elif line[0:1] == '{':
 			pprint.pprint(json.loads(line), width=200) # sort_dicts=False added in v3.8
 		else:
-			print(line[:-2])
+			print(line)
 
+	# NDJSON: one rule per row, the columns are the fields of all lines
+	if len(records) > 0:
+		columns = []
+		for record in records:
+			columns.extend(column for column in record if column not in columns)
+		widths = [max([len(column)] + [len(str(record.get(column))) for record in records]) for column in columns]
+		print("  ".join(column.ljust(width) for column, width in zip(columns, widths)).rstrip())
+		for record in records:
+			print("  ".join(str(record.get(column)).ljust(width) for column, width in zip(columns, widths)).rstrip())
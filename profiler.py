@@ -0,0 +1,234 @@
+#-------------------------------------------------------------------------------
+# Micro Server - On demand profiling
+#
+# While active a sampling thread records the stacks of the threads handling
+# requests every cEnvVars.PROFILE_INTERVAL seconds, and each request records
+# the time spent in its phases (read, parse, lock, exec, encode, send). The
+# cEnvVars.PROFILE_SLOWEST slowest requests are kept. Profiling stops after a
+# number of seconds or requests, the report is then written to
+# cEnvVars.PROFILE_DIR and kept for download.
+#
+# When inactive phase() and locked() return objects that do no timing, the
+# request path only pays for an attribute test.
+#
+# Copyright (c) 2022 Robert I. Gike
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#-------------------------------------------------------------------------------
+
+import collections, contextlib, datetime, heapq, os, sys, tempfile, threading, time
+
+from envvars import cEnvVars
+
+g_null_phase = contextlib.nullcontext()
+
+#-------------------------------------------------------------------------------
+# cPhaseTimer - add the time spent in a with block to the request record
+#-------------------------------------------------------------------------------
+class cPhaseTimer:
+	def __init__(self, record, name):
+		self.record = record
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+	def __exit__(self, *args):
+		phases = self.record["phases"]
+		phases[self.name] = phases.get(self.name, 0.0) + time.perf_counter() - self.start
+
+#-------------------------------------------------------------------------------
+# cLockTimer - acquire a lock, timing the wait as phase "lock"
+#-------------------------------------------------------------------------------
+class cLockTimer(cPhaseTimer):
+	def __init__(self, record, lock):
+		super().__init__(record, "lock")
+		self.lock = lock
+
+	def __enter__(self):
+		super().__enter__()
+		self.lock.acquire()
+		super().__exit__()
+
+	def __exit__(self, *args):
+		self.lock.release()
+
+#-------------------------------------------------------------------------------
+# cProfiler
+#-------------------------------------------------------------------------------
+class cProfiler:
+	def __init__(self):
+		self.active = False
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.report = None
+		self.report_file = None
+		self.sampler = None
+
+	#---------------------------------------------------------------------------
+	# control
+	#---------------------------------------------------------------------------
+	# start profiling for at most seconds and/or requests, False if active
+	def start(self, seconds=None, requests=None):
+		with self.lock:
+			if self.active: return False
+			self.seconds = seconds if seconds is not None else cEnvVars.PROFILE_SECONDS
+			self.max_requests = requests
+			self.started = datetime.datetime.utcnow()
+			self.deadline = time.monotonic() + self.seconds
+			self.requests = 0
+			self.slowest = []
+			self.stacks = collections.Counter()
+			self.sample_count = 0
+			self.in_flight = dict()
+			self.stop_event = threading.Event()
+			self.active = True
+			self.sampler = threading.Thread(target=self.sample, name="ProfileSampler", daemon=True)
+			self.sampler.start()
+		print("Profiling started: seconds={} requests={}".format(self.seconds, requests))
+		return True
+
+	# stop profiling, write and keep the report, False if not active
+	def stop(self):
+		with self.lock:
+			if not self.active: return False
+			self.active = False
+			self.stop_event.set()
+			self.report = self.construct_report()
+		self.report_file = self.write_report(self.report)
+		print("Profiling stopped: report {}".format(self.report_file))
+		return True
+
+	def toggle(self):
+		if not self.stop(): self.start()
+
+	#---------------------------------------------------------------------------
+	# request instrumentation
+	#---------------------------------------------------------------------------
+	def begin_request(self):
+		if not self.active: return
+		record = { "start": time.perf_counter(), "phases": dict(), "path": None }
+		self.local.record = record
+		with self.lock:
+			if self.active: self.in_flight[threading.get_ident()] = record
+
+	def end_request(self, path):
+		record = getattr(self.local, "record", None)
+		if record is None: return
+		self.local.record = None
+		record["path"] = path
+		record["total"] = time.perf_counter() - record["start"]
+		stop = False
+		with self.lock:
+			if not self.active: return
+			self.in_flight.pop(threading.get_ident(), None)
+			self.requests += 1
+			entry = (record["total"], self.requests, record)
+			if len(self.slowest) < cEnvVars.PROFILE_SLOWEST:
+				heapq.heappush(self.slowest, entry)
+			else:
+				heapq.heappushpop(self.slowest, entry)
+			stop = self.max_requests is not None and self.requests >= self.max_requests
+		if stop: self.stop()
+
+	def phase(self, name):
+		if not self.active: return g_null_phase
+		record = getattr(self.local, "record", None)
+		if record is None: return g_null_phase
+		return cPhaseTimer(record, name)
+
+	# use in place of 'with lock:' to time the lock wait
+	def locked(self, lock):
+		if not self.active: return lock
+		record = getattr(self.local, "record", None)
+		if record is None: return lock
+		return cLockTimer(record, lock)
+
+	#---------------------------------------------------------------------------
+	# stack sampling
+	#---------------------------------------------------------------------------
+	def sample(self):
+		stop_event = self.stop_event
+		while not stop_event.wait(cEnvVars.PROFILE_INTERVAL):
+			if time.monotonic() >= self.deadline:
+				self.stop()
+				break
+			frames = sys._current_frames()
+			with self.lock:
+				if not self.active: break
+				self.sample_count += 1
+				for ident in self.in_flight:
+					frame = frames.get(ident, None)
+					if frame is not None: self.stacks[collapse_stack(frame)] += 1
+
+	#---------------------------------------------------------------------------
+	# report
+	#---------------------------------------------------------------------------
+	def construct_report(self):
+		slowest = []
+		for total, number, record in sorted(self.slowest, reverse=True):
+			phases = { name: round(record["phases"][name] * 1000, 3) for name in record["phases"] }
+			slowest.append({ "path": record["path"], "total_ms": round(total * 1000, 3), "phases_ms": phases })
+		return {
+		"started":  self.started.strftime("%Y.%m.%d-%H:%M:%S.%f UTC"),
+		"stopped":  datetime.datetime.utcnow().strftime("%Y.%m.%d-%H:%M:%S.%f UTC"),
+		"requests": self.requests,
+		"samples":  self.sample_count,
+		"slowest":  slowest,
+		"stacks":   self.stacks.most_common(),
+		}
+
+	def status(self):
+		with self.lock:
+			return {
+			"active":      self.active,
+			"report":      self.report is not None,
+			"report_file": self.report_file,
+			}
+
+	# the report in text form: slowest requests followed by the collapsed
+	# stacks, one 'frame;frame;... count' line each (flame graph input)
+	def report_text(self, report):
+		lines = [ "# started {} stopped {} requests {} samples {}".format(
+		          report["started"], report["stopped"], report["requests"], report["samples"]) ]
+		for request in report["slowest"]:
+			phases = " ".join("{}={}".format(name, request["phases_ms"][name]) for name in sorted(request["phases_ms"]))
+			lines.append("# {} ms {} {}".format(request["total_ms"], request["path"], phases))
+		for stack, count in report["stacks"]:
+			lines.append("{} {}".format(stack, count))
+		return "\n".join(lines) + "\n"
+
+	# the report file is created new (O_EXCL, mode 0600) under a unique name,
+	# an existing file or symlink in the directory is never followed
+	def write_report(self, report):
+		try:
+			fd, path = tempfile.mkstemp(dir=cEnvVars.PROFILE_DIR, suffix=".txt",
+			                            prefix="ms_iptables-profile-{}-".format(
+			                            datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")))
+			with os.fdopen(fd, "w") as f:
+				f.write(self.report_text(report))
+		except OSError as error:
+			print("cProfiler.write_report():", error)
+			return None
+		return path
+
+#-------------------------------------------------------------------------------
+def collapse_stack(frame):
+	names = []
+	while frame is not None:
+		code = frame.f_code
+		names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+		frame = frame.f_back
+	return ";".join(reversed(names))
+
+g_profiler = cProfiler()
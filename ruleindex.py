@@ -0,0 +1,340 @@
+#-------------------------------------------------------------------------------
+# IP Tables Control - Compiled INPUT chain match index
+#
+# Answers which INPUT rule a hypothetical packet would hit first. Each match
+# dimension maps a packet field to the set of rules it satisfies, sets are
+# held as int bit masks with bit n for rule number n. The first matching rule
+# is the lowest bit set in the AND of all dimensions.
+#
+#   src, dst - binary radix tree of the -s / -d CIDR prefixes
+#   dport    - sorted port interval boundaries of --dport / --dports
+#   proto    - -p protocol buckets
+#   iface    - -i interface buckets, name+ wildcards
+#   state    - --state / --ctstate buckets
+#
+# Rule options the index does not model (--icmp-type, --sport, -m limit ...)
+# are ignored and the rule is reported as approximate.
+#
+# Copyright (c) 2022 Robert I. Gike
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#-------------------------------------------------------------------------------
+
+import bisect, datetime, ipaddress, re, shlex
+
+from rulesource import get_rule_source, split_rules
+from threading  import Lock
+
+# built in targets which end the chain traversal with a verdict
+TERMINATING = ["ACCEPT", "DROP", "REJECT", "QUEUE", "NFQUEUE"]
+
+# built in targets which do not end the chain traversal
+NON_TERMINATING = ["LOG", "NFLOG", "ULOG", "MARK", "CONNMARK", "TRACE", "AUDIT"]
+
+PROTOCOLS = { "1": "icmp", "6": "tcp", "17": "udp", "58": "ipv6-icmp", "icmpv6": "ipv6-icmp" }
+
+# packet fields accepted by cRuleIndex.evaluate()
+PACKET_FIELDS = ["src", "dst", "proto", "dport", "iface", "state"]
+
+# per IP version: (source, snapshot key, rule text, index)
+g_index_cache = { 4: (None, None, None, None), 6: (None, None, None, None) }
+g_index_lock  = Lock()
+
+#-------------------------------------------------------------------------------
+# cMatchDimension - rules without a constraint plus positive and negated (!)
+# constraints on one packet field
+#-------------------------------------------------------------------------------
+class cMatchDimension:
+	def __init__(self):
+		self.wildcard = 0
+		self.negated = 0
+
+	def add_wildcard(self, bit):
+		self.wildcard |= bit
+
+	def add(self, value, bit, negate):
+		if negate: self.negated |= bit
+		self.insert(value, bit, negate)
+
+	# the rules matching value, only unconstrained rules match a missing value
+	def match(self, value):
+		if value is None: return self.wildcard
+		return self.wildcard | self.lookup(value, False) | (self.negated & ~self.lookup(value, True))
+
+#-------------------------------------------------------------------------------
+# cBucketDimension - exact values, names ending in '+' match by prefix
+#-------------------------------------------------------------------------------
+class cBucketDimension(cMatchDimension):
+	def __init__(self):
+		super().__init__()
+		self.buckets = [dict(), dict()]
+		self.prefixes = [[], []]
+
+	def insert(self, value, bit, negate):
+		if value.endswith('+'):
+			self.prefixes[negate].append((value[:-1], bit))
+		else:
+			self.buckets[negate][value] = self.buckets[negate].get(value, 0) | bit
+
+	def lookup(self, value, negate):
+		mask = self.buckets[negate].get(value, 0)
+		for prefix, bit in self.prefixes[negate]:
+			if value.startswith(prefix): mask |= bit
+		return mask
+
+#-------------------------------------------------------------------------------
+# cPrefixDimension - binary radix tree, a node is [child 0, child 1, mask]
+#-------------------------------------------------------------------------------
+class cPrefixDimension(cMatchDimension):
+	def __init__(self, bits):
+		super().__init__()
+		self.bits = bits
+		self.roots = [[None, None, 0], [None, None, 0]]
+
+	def insert(self, network, bit, negate):
+		node = self.roots[negate]
+		address = int(network.network_address)
+		for i in range(network.prefixlen):
+			branch = (address >> (self.bits - 1 - i)) & 1
+			if node[branch] is None: node[branch] = [None, None, 0]
+			node = node[branch]
+		node[2] |= bit
+
+	# OR of the masks of every prefix on the path to the address
+	def lookup(self, address, negate):
+		node = self.roots[negate]
+		mask = node[2]
+		shift = self.bits - 1
+		while shift >= 0:
+			node = node[(address >> shift) & 1]
+			if node is None: break
+			mask |= node[2]
+			shift -= 1
+		return mask
+
+#-------------------------------------------------------------------------------
+# cPortDimension - port intervals split into elementary segments
+#-------------------------------------------------------------------------------
+class cPortDimension(cMatchDimension):
+	def __init__(self):
+		super().__init__()
+		self.intervals = [[], []]
+		self.starts = [[], []]
+		self.masks = [[], []]
+
+	def insert(self, interval, bit, negate):
+		self.intervals[negate].append((interval[0], interval[1], bit))
+
+	# segment k covers ports starts[k] up to starts[k+1]-1
+	def compile(self):
+		for negate in [0, 1]:
+			points = set([0])
+			for low, high, bit in self.intervals[negate]:
+				points.add(low)
+				points.add(high + 1)
+			self.starts[negate] = sorted(points)
+			self.masks[negate] = [0] * len(self.starts[negate])
+			for low, high, bit in self.intervals[negate]:
+				first = bisect.bisect_left(self.starts[negate], low)
+				last = bisect.bisect_left(self.starts[negate], high + 1)
+				for k in range(first, last):
+					self.masks[negate][k] |= bit
+
+	def lookup(self, port, negate):
+		return self.masks[negate][bisect.bisect_right(self.starts[negate], port) - 1]
+
+#-------------------------------------------------------------------------------
+# cRuleIndex
+#-------------------------------------------------------------------------------
+class cRuleIndex:
+	# rules - rule text list indexed by rule number
+	def __init__(self, ver, rules):
+		self.ver = ver
+		self.rules = rules
+		self.datetime = datetime.datetime.utcnow().strftime("%Y.%m.%d-%H:%M:%S.%f UTC")
+		self.policy = None
+		self.targets = dict()
+		self.approximate = 0
+		self.all = 0
+		self.src = cPrefixDimension(32 if ver == 4 else 128)
+		self.dst = cPrefixDimension(32 if ver == 4 else 128)
+		self.dport = cPortDimension()
+		self.proto = cBucketDimension()
+		self.iface = cBucketDimension()
+		self.state = cBucketDimension()
+		for rule_number, text in enumerate(rules):
+			self.compile_rule(rule_number, text)
+		self.dport.compile()
+		# without the policy every verdict falling through the chain is unknown
+		if self.policy is None:
+			raise ValueError("The IPv{} rules have no INPUT chain policy".format(ver))
+
+	def compile_rule(self, rule_number, text):
+		m = re.match(r'^-P\sINPUT\s([^\s]+)', text)
+		if m:
+			self.policy = m.group(1)
+			return
+		tokens = shlex.split(text)
+		if len(tokens) < 2 or tokens[0] != "-A": return
+
+		bit = 1 << rule_number
+		constrained = set()
+		negate = False
+		i = 2
+		while i < len(tokens):
+			option = tokens[i]
+			value = tokens[i+1] if i+1 < len(tokens) else None
+			i += 1
+			if option == "!":
+				negate = True
+				continue
+			if option in ["-s", "--source", "-d", "--destination"]:
+				dimension = self.src if option in ["-s", "--source"] else self.dst
+				dimension.add(ipaddress.ip_network(value, strict=False), bit, negate)
+				constrained.add(dimension)
+			elif option in ["-p", "--protocol"]:
+				if value.lower() != "all":
+					self.proto.add(normalize_protocol(value), bit, negate)
+					constrained.add(self.proto)
+			elif option in ["-i", "--in-interface"]:
+				self.iface.add(value, bit, negate)
+				constrained.add(self.iface)
+			elif option in ["--dport", "--destination-port", "--dports", "--destination-ports"]:
+				for ports in value.split(','):
+					self.dport.add(parse_port_range(ports), bit, negate)
+				constrained.add(self.dport)
+			elif option in ["--state", "--ctstate"]:
+				for state in value.split(','):
+					self.state.add(state.upper(), bit, negate)
+				constrained.add(self.state)
+			elif option in ["-j", "--jump", "-g", "--goto"]:
+				# the remaining options belong to the target
+				self.targets[rule_number] = value
+				break
+			elif option in ["-m", "--match"]:
+				pass
+			elif option == "--comment":
+				pass
+			elif option.startswith('-'):
+				# not modelled, skip the option arguments
+				self.approximate |= bit
+				while i < len(tokens) and not tokens[i].startswith('-') and tokens[i] != "!": i += 1
+				negate = False
+				continue
+			else:
+				continue
+			i += 1
+			negate = False
+
+		for dimension in [self.src, self.dst, self.dport, self.proto, self.iface, self.state]:
+			if dimension not in constrained: dimension.add_wildcard(bit)
+		self.all |= bit
+
+	# return (rule number, verdict, approximate) for a packet dict with the
+	# PACKET_FIELDS keys, rule number 0 is the chain policy
+	#
+	# User defined chains and other targets are not followed, the packet
+	# continues with the next rule and the result is approximate.
+	def evaluate(self, packet):
+		src = packet.get("src", None)
+		dst = packet.get("dst", None)
+		candidates = (self.all
+		              & self.src.match(None if src is None else int(src))
+		              & self.dst.match(None if dst is None else int(dst))
+		              & self.dport.match(packet.get("dport", None))
+		              & self.proto.match(packet.get("proto", None))
+		              & self.iface.match(packet.get("iface", None))
+		              & self.state.match(packet.get("state", None)))
+		approximate = False
+		while candidates:
+			rule_number = (candidates & -candidates).bit_length() - 1
+			bit = 1 << rule_number
+			approximate = approximate or (self.approximate & bit) != 0
+			target = self.targets.get(rule_number, None)
+			if target == "RETURN": break
+			if target in TERMINATING:
+				return (rule_number, target, approximate)
+			if target is not None and target not in NON_TERMINATING:
+				approximate = True
+			candidates &= ~bit
+		return (0, self.policy, approximate)
+
+#-------------------------------------------------------------------------------
+# get_rule_index - the compiled index of the current rule source snapshot
+#
+# A source with a snapshot key (file mtime and size, memory text) is not read
+# again while the key is unchanged. Otherwise the rules are fetched and the
+# index is rebuilt only when the rule text changed.
+#-------------------------------------------------------------------------------
+def get_rule_index(ver):
+	source = get_rule_source()
+	key = source.snapshot_key(ver)
+	with g_index_lock:
+		cached_source, cached_key, cached_text, index = g_index_cache[ver]
+		if key is not None and cached_source is source and cached_key == key:
+			return index
+
+	text = source.fetch(ver)
+	with g_index_lock:
+		cached_source, cached_key, cached_text, index = g_index_cache[ver]
+		if cached_source is source and cached_text == text:
+			g_index_cache[ver] = (source, key, text, index)
+			return index
+
+	index = cRuleIndex(ver, split_rules(text))
+	with g_index_lock:
+		g_index_cache[ver] = (source, key, text, index)
+	return index
+
+def normalize_protocol(protocol):
+	protocol = protocol.lower()
+	return PROTOCOLS.get(protocol, protocol)
+
+def parse_port_range(ports):
+	low, sep, high = ports.partition(':')
+	low = int(low) if len(low) > 0 else 0
+	high = int(high) if len(high) > 0 else (65535 if sep == ':' else low)
+	return (low, high)
+
+#-------------------------------------------------------------------------------
+# parse_packet - validate packet fields given as strings, raise ValueError
+#-------------------------------------------------------------------------------
+def parse_packet(ver, fields):
+	packet = dict()
+	for name in fields:
+		if name not in PACKET_FIELDS:
+			raise ValueError("Invalid packet field '{}'. Valid fields: {}".format(name, " ".join(PACKET_FIELDS)))
+		value = fields[name]
+		if value is None or len(str(value)) == 0: continue
+		value = str(value)
+		if name in ["src", "dst"]:
+			try:
+				address = ipaddress.ip_address(value)
+			except ValueError:
+				raise ValueError("Invalid {} address '{}'".format(name, value))
+			if address.version != ver:
+				raise ValueError("The {} address '{}' is not IPv{}".format(name, value, ver))
+			packet[name] = address
+		elif name == "dport":
+			if not value.isdigit() or int(value) > 65535:
+				raise ValueError("Invalid dport '{}'".format(value))
+			packet[name] = int(value)
+		elif name == "proto":
+			packet[name] = normalize_protocol(value)
+		elif name == "state":
+			packet[name] = value.upper()
+		else:
+			packet[name] = value
+	# a packet is a new connection unless stated otherwise
+	packet.setdefault("state", "NEW")
+	return packet
@@ -0,0 +1,281 @@
+#-------------------------------------------------------------------------------
+# IP Tables Control - Rule sources
+#
+# A rule source supplies the INPUT chain of one IP version in 'iptables -S'
+# format. cIPTables parses whatever the configured source returns. A source
+# also supplies the rules together with their packet and byte counters, both
+# indexed by the rule numbers cIPTables assigns: 0 is the chain policy, 1..
+# the rules.
+#
+#   exec   - run iptables -S / ip6tables -S (requires root)
+#   file   - iptables-save / ip6tables-save dump files
+#   memory - in memory rule text, defaults to the built in sample rules
+#
+# Copyright (c) 2022 Robert I. Gike
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#-------------------------------------------------------------------------------
+
+import os, re, subprocess, traceback
+
+from envvars   import cEnvVars
+from profiler  import g_profiler
+from threading import Lock
+
+sample_rules_ipv4 = """
+-P INPUT DROP
+-A INPUT -i lo -j ACCEPT
+-A INPUT -i enp1s0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+-A INPUT -i enp1s0 -p icmp -m icmp --icmp-type 8 -m comment --comment Public_ECHO -j ACCEPT
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 22 -m comment --comment Public_SSH -j ACCEPT
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 80 -m comment --comment Public_HTTP -j LOG_DROP2
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 443 -m comment --comment Public_HTTPS -j LOG_DROP2
+-A INPUT -d 224.0.0.1/32 -i enp1s0 -j LOG_DROP3
+-A INPUT -i enp1s0 -p udp -m udp --dport 137 -j LOG_DROP2
+-A INPUT -i enp1s0 -p udp -m udp --dport 138 -j LOG_DROP2
+-A INPUT -j LOG_DROP2
+"""
+
+sample_rules_ipv6 = """
+-P INPUT DROP
+-A INPUT -i lo -j ACCEPT
+-A INPUT -i enp1s0 -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT
+-A INPUT -i enp1s0 -p ipv6-icmp -m comment --comment Public_ICMP -j LOG_DROP2
+-A INPUT -s fe80::/10 -i enp1s0 -p udp -m state --state NEW -m udp --dport 546 -m comment --comment DHCP_546 -j ACCEPT
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 22 -m comment --comment Public_SSH -j ACCEPT
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 80 -m comment --comment Public_HTTP -j LOG_DROP2
+-A INPUT -i enp1s0 -p tcp -m state --state NEW -m tcp --dport 443 -m comment --comment Public_HTTPS -j LOG_DROP2
+-A INPUT -j LOG_DROP2
+"""
+
+g_rule_source      = None
+g_rule_source_lock = Lock()
+
+#-------------------------------------------------------------------------------
+# cRuleSource - base class
+#
+# A source implements
+#
+#   fetch(ver)          - the INPUT chain rules for IP version 4 or 6 in
+#                         'iptables -S' format
+#   fetch_stats(ver)    - { "rules": rule text list, "counters": list of
+#                         [packets, bytes] }, both indexed by rule number and
+#                         taken from the same snapshot
+#   snapshot_key(ver)   - a value which changes whenever fetch(ver) would
+#                         return different rules, None if unknown without
+#                         fetching
+#
+# is_live is True when rule updates are applied to the running system.
+#-------------------------------------------------------------------------------
+class cRuleSource:
+	is_live = False
+
+	def check_version(self, ver):
+		if ver not in [4, 6]: raise Exception("{}.fetch() IP version {}".format(type(self).__name__, ver))
+
+#-------------------------------------------------------------------------------
+# cExecRuleSource - live rules from iptables -S / ip6tables -S
+#-------------------------------------------------------------------------------
+class cExecRuleSource(cRuleSource):
+	is_live = True
+
+	re_counters = re.compile(r'\s-c\s([0-9]+)\s([0-9]+)')
+
+	def snapshot_key(self, ver):
+		return None
+
+	def fetch(self, ver):
+		self.check_version(ver)
+		ret = exec("/sbin/iptables -S INPUT" if ver == 4 else "/sbin/ip6tables -S INPUT")
+		self.check_result("fetch", ret)
+		return ret["stdout"] or ""
+
+	# 'iptables -S INPUT -v' adds '-c packets bytes' to every rule
+	def fetch_stats(self, ver):
+		self.check_version(ver)
+		ret = exec("/sbin/iptables -S INPUT -v" if ver == 4 else "/sbin/ip6tables -S INPUT -v")
+		self.check_result("fetch_stats", ret)
+		rules = []
+		counters = []
+		for line in split_rules(ret["stdout"] or ""):
+			m = self.re_counters.search(line)
+			counters.append([int(m.group(1)), int(m.group(2))] if m else [0, 0])
+			rules.append(self.re_counters.sub("", line))
+		return { "rules": rules, "counters": counters }
+
+	# a command which could not run or exited non zero has no usable output
+	def check_result(self, name, ret):
+		if ret["exception"]:
+			raise Exception("cExecRuleSource.{}() {}".format(name, ret["stdout"]))
+		if ret["returncode"] != 0:
+			raise Exception("cExecRuleSource.{}() exit code {}: {}".format(name, ret["returncode"], (ret["stderr"] or "").strip()))
+
+#-------------------------------------------------------------------------------
+# cFileRuleSource - rules from iptables-save / ip6tables-save dump files
+#
+# The dump is read, not memory mapped, a map faults (SIGBUS) when the dump is
+# rewritten in place and shrinks. Only the INPUT chain of the filter table is
+# extracted. The result is cached and the file is parsed again only when its
+# modification time or size changes. Counters are taken from the [pkts:bytes]
+# prefixes written by iptables-save -c and are 0 when the dump has none. Both
+# files are read when the source is created.
+#-------------------------------------------------------------------------------
+class cFileRuleSource(cRuleSource):
+	re_table  = re.compile(rb'^\*filter[ \t]*$', re.M)
+	re_commit = re.compile(rb'^COMMIT[ \t]*$', re.M)
+	re_policy = re.compile(rb'^:INPUT[ \t]+([^\s]+)(?:[ \t]+\[([0-9]+):([0-9]+)\])?', re.M)
+	re_rule   = re.compile(rb'^(?:\[([0-9]+):([0-9]+)\][ \t]+)?(-A[ \t]+INPUT[ \t][^\r\n]*?)[ \t]*\r?$', re.M)
+
+	def __init__(self, path4=None, path6=None):
+		self.paths = {
+		4: path4 if path4 is not None else cEnvVars.RULE_FILE_4,
+		6: path6 if path6 is not None else cEnvVars.RULE_FILE_6,
+		}
+		self.cache = { 4: (None, None), 6: (None, None) }
+		self.lock = Lock()
+		# a missing or unreadable dump fails when the source is created
+		for ver in [4, 6]:
+			self.load(ver)
+
+	def fetch(self, ver):
+		return self.load(ver)["text"]
+
+	def snapshot_key(self, ver):
+		self.check_version(ver)
+		st = os.stat(self.paths[ver])
+		return (st.st_mtime_ns, st.st_size)
+
+	def fetch_stats(self, ver):
+		snapshot = self.load(ver)
+		return { "rules": split_rules(snapshot["text"]), "counters": snapshot["counters"] }
+
+	def load(self, ver):
+		self.check_version(ver)
+		st = os.stat(self.paths[ver])
+		key = (st.st_mtime_ns, st.st_size)
+		with self.lock:
+			if self.cache[ver][0] != key:
+				self.cache[ver] = (key, self.parse_file(self.paths[ver]))
+				if cEnvVars.verbose_debug: print("cFileRuleSource.load(): loaded", self.paths[ver])
+			return self.cache[ver][1]
+
+	def parse_file(self, path):
+		with open(path, "rb") as f:
+			return self.parse_dump(f.read())
+
+	# parse iptables-save output held in a bytes like object
+	def parse_dump(self, data):
+		start = 0
+		end = len(data)
+		m = self.re_table.search(data)
+		if m:
+			start = m.end()
+			m = self.re_commit.search(data, start)
+			if m: end = m.start()
+
+		lines = []
+		counters = []
+		m = self.re_policy.search(data, start, end)
+		if m:
+			lines.append("-P INPUT " + m.group(1).decode())
+			counters.append([int(m.group(2) or 0), int(m.group(3) or 0)])
+		for m in self.re_rule.finditer(data, start, end):
+			lines.append(m.group(3).decode())
+			counters.append([int(m.group(1) or 0), int(m.group(2) or 0)])
+		return { "text": "\n".join(lines) + "\n", "counters": counters }
+
+#-------------------------------------------------------------------------------
+# cMemoryRuleSource - in memory rules, the sample rules by default
+#-------------------------------------------------------------------------------
+class cMemoryRuleSource(cRuleSource):
+	def __init__(self, rules4=sample_rules_ipv4, rules6=sample_rules_ipv6):
+		self.rules = { 4: rules4, 6: rules6 }
+
+	def fetch(self, ver):
+		self.check_version(ver)
+		return self.rules[ver]
+
+	# the in memory rules never see traffic
+	def fetch_stats(self, ver):
+		self.check_version(ver)
+		rules = split_rules(self.rules[ver])
+		return { "rules": rules, "counters": [[0, 0] for rule in rules] }
+
+	def snapshot_key(self, ver):
+		self.check_version(ver)
+		return self.rules[ver]
+
+	def set_rules(self, ver, text):
+		self.check_version(ver)
+		self.rules[ver] = text
+
+#-------------------------------------------------------------------------------
+# get_rule_source - return the shared rule source, created on first use
+#-------------------------------------------------------------------------------
+def get_rule_source():
+	global g_rule_source
+	with g_rule_source_lock:
+		if g_rule_source is None:
+			g_rule_source = new_rule_source(cEnvVars.RULE_SOURCE)
+		return g_rule_source
+
+def new_rule_source(name):
+	if name == "auto":
+		name = "exec" if os.getuid()==0 else "memory"
+	switch = {
+	"exec":   cExecRuleSource,
+	"file":   cFileRuleSource,
+	"memory": cMemoryRuleSource,
+	}
+	source = switch.get(name, None)
+	if source is None: raise Exception("Invalid rule source '{}'. Valid sources: auto exec file memory".format(name))
+	return source()
+
+def set_rule_source(source):
+	global g_rule_source
+	with g_rule_source_lock:
+		g_rule_source = source
+
+#-------------------------------------------------------------------------------
+# split_rules - the rule lines of 'iptables -S' text, numbered from 0 the way
+# cIPTables.parse_iptables_rules() numbers them
+#-------------------------------------------------------------------------------
+def split_rules(text):
+	return [line for line in text.split('\n') if len(line) >= 4]
+
+#-------------------------------------------------------------------------------
+# exec - execute a command line, return [exception flag, exit code, stderr,
+# stdout], the exit code is None when the command could not be run
+#-------------------------------------------------------------------------------
+def exec(cmdline):
+	stderror   = None
+	stdoutput  = None
+	exception  = False
+	returncode = None
+	try:
+		if cEnvVars.verbose_debug:
+			print("cmdline=[{}]\n        {}".format(cmdline, cmdline.split()))
+		with g_profiler.phase("exec"):
+			proc = subprocess.run(cmdline.split(),
+								  stdout=subprocess.PIPE,
+								  stderr=subprocess.PIPE)
+		returncode = proc.returncode
+		if proc.stderr is not None and len(proc.stderr) > 0:
+			stderror  = proc.stderr.decode()
+		if proc.stdout is not None and len(proc.stdout) > 0:
+			stdoutput = proc.stdout.decode()
+	except FileNotFoundError as e:
+		exception = True
+		stderror = traceback.print_exc()
+		stdoutput = "{}".format(e)
+	return { "exception":exception, "returncode":returncode, "stderr":stderror, "stdout":stdoutput }
@@ -0,0 +1,118 @@
+#-------------------------------------------------------------------------------
+# IP Tables Control - Rule counter sampling
+#
+# A background thread samples the INPUT chain rules and their packet and byte
+# counters of both IP versions from the rule source every
+# cEnvVars.STATS_INTERVAL seconds and keeps the last cEnvVars.STATS_SAMPLES
+# samples. Requests read the latest sample, rates are computed across the
+# samples held in the ring.
+#
+# Copyright (c) 2022 Robert I. Gike
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#-------------------------------------------------------------------------------
+
+import collections, datetime, threading, time
+
+from envvars    import cEnvVars
+from rulesource import get_rule_source
+
+g_stats_sampler = None
+
+#-------------------------------------------------------------------------------
+# cRuleStatsSampler
+#-------------------------------------------------------------------------------
+class cRuleStatsSampler(threading.Thread):
+	def __init__(self, interval=None, samples=None):
+		super().__init__(name="RuleStatsSampler", daemon=True)
+		self.lock = threading.Lock()
+		self.samples = { 4: collections.deque(), 6: collections.deque() }
+		self.stop_event = threading.Event()
+		self.configure(interval, samples)
+
+	# change the interval and ring size, the samples held are kept
+	def configure(self, interval=None, samples=None):
+		samples = samples if samples is not None else cEnvVars.STATS_SAMPLES
+		with self.lock:
+			self.interval = interval if interval is not None else cEnvVars.STATS_INTERVAL
+			for ver in [4, 6]:
+				self.samples[ver] = collections.deque(self.samples[ver], maxlen=max(samples, 2))
+
+	def run(self):
+		while True:
+			for ver in [4, 6]:
+				self.sample(ver)
+			if self.stop_event.wait(self.interval): break
+
+	def sample(self, ver):
+		try:
+			snapshot = get_rule_source().fetch_stats(ver)
+		except Exception as error:
+			print("cRuleStatsSampler.sample() IP version {}: {}".format(ver, error))
+			return
+		sample = {
+		"datetime":  datetime.datetime.utcnow().strftime("%Y.%m.%d-%H:%M:%S.%f UTC"),
+		"time":      time.monotonic(),
+		"rules":     snapshot["rules"],
+		"counters":  snapshot["counters"],
+		}
+		with self.lock:
+			self.samples[ver].append(sample)
+
+	# return the latest sample with per rule rates, None before the first sample
+	#
+	# Rates use the oldest sample in the ring with the same rules, a rule
+	# whose counters went backwards (counters zeroed) reports no rate.
+	def stats(self, ver):
+		with self.lock:
+			if len(self.samples[ver]) == 0: return None
+			latest = self.samples[ver][-1]
+			oldest = latest
+			for sample in self.samples[ver]:
+				if sample["rules"] == latest["rules"]:
+					oldest = sample
+					break
+
+		window = latest["time"] - oldest["time"]
+		rules = []
+		for rule_number, (text, (packets, nbytes)) in enumerate(zip(latest["rules"], latest["counters"])):
+			packets_rate = None
+			bytes_rate = None
+			if window > 0:
+				old_packets, old_bytes = oldest["counters"][rule_number]
+				if packets >= old_packets and nbytes >= old_bytes:
+					packets_rate = round((packets - old_packets) / window, 3)
+					bytes_rate = round((nbytes - old_bytes) / window, 3)
+			rules.append({
+			"number":      rule_number,
+			"text":        text,
+			"packets":     packets,
+			"bytes":       nbytes,
+			"packets_sec": packets_rate,
+			"bytes_sec":   bytes_rate,
+			})
+		return { "datetime": latest["datetime"], "interval": self.interval, "window": round(window, 3), "rules": rules }
+
+	def stop(self):
+		self.stop_event.set()
+
+#-------------------------------------------------------------------------------
+def get_stats_sampler():
+	return g_stats_sampler
+
+def start_stats_sampler():
+	global g_stats_sampler
+	if g_stats_sampler is None:
+		g_stats_sampler = cRuleStatsSampler()
+		g_stats_sampler.start()
+	return g_stats_sampler
@@ -16,50 +16,167 @@
 # limitations under the License.
 #-------------------------------------------------------------------------------
 
+import os
+import re
+import signal
 import socket
 import socketserver
 import sys
 import threading
 import time
+import traceback
 
 from envvars import cEnvVars
-from httphandler import cHttpRequest, cHttpResponse
+from httphandler import cBadRequest, cHttpRequest, cHttpResponse
+from profiler import g_profiler
 
+g_active_cond   = threading.Condition()
+g_active_count  = 0
 g_debug         = False
+g_profile_flag  = False
 g_handler       = None
+g_reload        = None
+g_reload_flag   = False
 g_request_count = 0
 g_shutdown      = False
+g_wakeup        = None
+
+MAX_HEADER = 16384
+
+#-------------------------------------------------------------------------------
+class cRequestTooLarge(Exception):
+	pass
 
 #-------------------------------------------------------------------------------
 class cThreadedTCPRequestHandler(socketserver.BaseRequestHandler):
 	def handle(self):
-		global g_request_count, g_shutdown
-		g_request_count += 1
+		global g_active_count, g_request_count
+		with g_active_cond:
+			g_active_count += 1
+			g_request_count += 1
+		g_profiler.begin_request()
+		self.path = None
+		try:
+			self.handleRequest()
+		finally:
+			g_profiler.end_request(self.path)
+			with g_active_cond:
+				g_active_count -= 1
+				g_active_cond.notify_all()
+
+	# an exception is contained to its own request and answered with a 500,
+	# a request which cannot be read or decoded with a 4xx status
+	def handleRequest(self):
 		try:
-			request = cHttpRequest(self.request.recv(1024))
+			with g_profiler.phase("read"):
+				data = self.receiveRequest()
+			# connected and closed without a request (port check)
+			if len(data) == 0: return
+			with g_profiler.phase("parse"):
+				request = cHttpRequest(data)
+			self.path = request.path
 			request.printDataIn()
 			if g_handler is None:
 				response = cHttpResponse("Request from {}\r\n".format(self.client_address))
 			else:
 				response = g_handler(request)
-			if g_debug: response.printDataOut()
-			self.request.sendall(response.bytesOut())
+		except cRequestTooLarge as error:
+			response = errorResponse(413, str(error))
+		except socket.timeout:
+			response = errorResponse(408, "Request not received within {} seconds".format(cEnvVars.RECV_TIMEOUT))
+		except cBadRequest as error:
+			response = errorResponse(400, str(error))
+		except UnicodeDecodeError:
+			response = errorResponse(400, "Request header is not ASCII or body is not UTF-8")
 		except Exception as error:
-			print(error)
-			output = "Exception!"
-			g_shutdown = True
+			traceback.print_exc()
+			response = errorResponse(500, "Unexpected error processing the request")
+		if g_debug: response.printDataOut()
+		try:
+			with g_profiler.phase("send"):
+				self.request.sendall(response.bytesOut())
+		except OSError as error:
+			print("Send to {} failed: {}".format(self.client_address, error))
+
+	# read the header and a body of Content-Length bytes
+	def receiveRequest(self):
+		self.request.settimeout(cEnvVars.RECV_TIMEOUT)
+		data = b""
+		while b"\r\n\r\n" not in data:
+			chunk = self.request.recv(4096)
+			if len(chunk) == 0: break
+			data += chunk
+			if b"\r\n\r\n" not in data and len(data) > MAX_HEADER:
+				raise cRequestTooLarge("Request header too large")
+
+		header, sep, body = data.partition(b"\r\n\r\n")
+		if len(header) > MAX_HEADER: raise cRequestTooLarge("Request header too large")
+		m = re.search(rb'\nContent-Length:[ \t]*([0-9]+)', header, re.I)
+		length = int(m.group(1)) if m else 0
+		if length > cEnvVars.MAX_BODY:
+			raise cRequestTooLarge("Request body larger than {} bytes".format(cEnvVars.MAX_BODY))
+		while len(body) < length:
+			chunk = self.request.recv(min(length - len(body), 65536))
+			if len(chunk) == 0: break
+			body += chunk
+		return header + sep + body
 
 #-------------------------------------------------------------------------------
 class cThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 	allow_reuse_address = True
+	# in flight requests are drained by ServerMain with a deadline
+	block_on_close = False
+	daemon_threads = True
 
 #-------------------------------------------------------------------------------
-def ServerMain(service_name, handler=None):
-	global g_handler, g_request_count, g_shutdown
+def errorResponse(status, detail):
+	response = cHttpResponse()
+	response.headerStatus(status)
+	response.headerDefaults()
+	response.errorResponse(detail=detail)
+	response.construct()
+	return response
+
+#-------------------------------------------------------------------------------
+# SIGTERM and SIGINT request shutdown, SIGHUP a configuration reload and
+# SIGUSR1 toggles profiling. The handler only records the signal and wakes up
+# the main loop.
+def signalHandler(signum, frame):
+	global g_profile_flag, g_reload_flag, g_shutdown
+	if signum == signal.SIGHUP:
+		g_reload_flag = True
+	elif signum == signal.SIGUSR1:
+		g_profile_flag = True
+	else:
+		g_shutdown = True
+	os.write(g_wakeup[1], b"x")
+
+#-------------------------------------------------------------------------------
+# Wait up to cEnvVars.DRAIN_TIMEOUT seconds for in flight requests, return the
+# number of requests still running
+def drainRequests():
+	deadline = time.monotonic() + cEnvVars.DRAIN_TIMEOUT
+	with g_active_cond:
+		while g_active_count > 0:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0: break
+			g_active_cond.wait(remaining)
+		return g_active_count
+
+#-------------------------------------------------------------------------------
+def ServerMain(service_name, handler=None, reload=None):
+	global g_handler, g_profile_flag, g_reload, g_reload_flag, g_wakeup
 	g_handler = handler
+	g_reload = reload
 
 	server = cThreadedTCPServer((cEnvVars.MS_IPTABLES_HOST, cEnvVars.MS_IPTABLES_PORT), cThreadedTCPRequestHandler)
 
+	g_wakeup = os.pipe()
+	signal.signal(signal.SIGHUP, signalHandler)
+	signal.signal(signal.SIGINT, signalHandler)
+	signal.signal(signal.SIGTERM, signalHandler)
+	signal.signal(signal.SIGUSR1, signalHandler)
+
 	# start the server thread
 	# additional threads will created to handle each request
 	server_thread = threading.Thread(target=server.serve_forever)
@@ -69,15 +186,24 @@ def ServerMain(service_name, handler=None):
 	server_thread.start()
 	print("Micro Service {} running in: {}".format(service_name, server_thread.name))
 
-	loop_count = 0
 	while not g_shutdown:
-		try:
-			time.sleep(5)
-			loop_count += 1
-		except KeyboardInterrupt:
-			print("\nKeyboardInterrupt: loop count={} requests={}".format(loop_count,g_request_count))
-			g_shutdown = True
+		os.read(g_wakeup[0], 64)
+		if g_reload_flag:
+			g_reload_flag = False
+			print("Micro Service {} reloading configuration".format(service_name))
+			try:
+				cEnvVars.load()
+				if g_reload is not None: g_reload()
+			except Exception as error:
+				print("Reload failed:", error)
+		if g_profile_flag:
+			g_profile_flag = False
+			g_profiler.toggle()
 
-	print("Micro Service {} shutdown now".format(service_name))
+	# stop accepting, then let the in flight requests finish
+	print("Micro Service {} shutdown now: requests={}".format(service_name, g_request_count))
 	server.shutdown()
-
+	server.server_close()
+	abandoned = drainRequests()
+	if abandoned > 0:
+		print("Micro Service {} drain timeout: {} requests abandoned".format(service_name, abandoned))